@@ -11,11 +11,20 @@
 
 from __future__ import print_function
 
-from collections import OrderedDict
-import copy
+import os
 from os.path import abspath, dirname, join
 import sys
-import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.cElementTree as ET
+
+# builtin dicts preserve insertion order starting with python 3.7
+if sys.version_info >= (3, 7):
+    ordered_dict = dict
+else:
+    from collections import OrderedDict as ordered_dict
 
 import xmlschema
 from xmlschema.builtins import XSD_BUILTIN_TYPES
@@ -26,15 +35,47 @@ from xmlschema.qnames import split_qname, split_reference, XSD_CHOICE_TAG
 
 ns_x = 'http://www.w3.org/2001/XMLSchema'
 
+ENUM_TAG = '{%s}enumeration' % ns_x
+
 namespaces = {
     'http://schemas.microsoft.com/exchange/services/2006/messages': 'm',
     'http://schemas.microsoft.com/exchange/services/2006/types': 't',
     ns_x: 'xs'
 }
 
+try:
+    _intern = sys.intern
+except AttributeError:
+    # python 2 can only intern byte strings, and xmlschema gives us unicode
+    def _intern(s):
+        return s
+
+# key: qname
+# value: (namespace, name, shortened qname)
+_qname_cache = {}
+
+def _split_qname(n):
+    '''Memoized version of split_qname that also precomputes the short name'''
+    try:
+        return _qname_cache[n]
+    except KeyError:
+        pass
+
+    ns, name = split_qname(n)
+    prefix = namespaces.get(ns)
+    if prefix is None:
+        short = None
+    else:
+        short = '%s:%s' % (prefix, name)
+
+    r = _qname_cache[n] = (ns, name, short)
+    return r
+
 def shorten_qname(n):
-    ns, n = split_qname(n)
-    return '%s:%s' % (namespaces[ns], n)
+    short = _split_qname(n)[2]
+    if short is None:
+        raise KeyError(_split_qname(n)[0])
+    return short
 
 
 # https://github.com/brunato/xmlschema/issues/10
@@ -55,7 +96,8 @@ XsdComplexType.extends_type = property(fget=_extends_type)
 
 class ElementData(object):
 
-    __slots__ = ['type', 'is_list', 'json_name', 'json_hint', 'xml_name', 'json_default']
+    __slots__ = ['type', 'is_list', 'json_name', 'json_hint', 'xml_name', 'json_default',
+                 'xml_short_name']
 
     def __init__(self, typ):
 
@@ -78,6 +120,17 @@ class ElementData(object):
         # -> if the XML does not contain a value for this element, insert this
         self.json_default = None
 
+        # shortened form of the XML name, set by TypeData.finish
+        # -> if it isn't, the renderer computes it from the element key
+        self.xml_short_name = None
+
+    def clone(self):
+        # shallow copy: type is shared, everything else is a scalar
+        new = ElementData.__new__(ElementData)
+        for s in ElementData.__slots__:
+            setattr(new, s, getattr(self, s))
+        return new
+
 class TypeData(object):
     '''
         Holds all of the data needed for transformation for XML schemas
@@ -87,20 +140,25 @@ class TypeData(object):
         'namespace', 'name', 'elements', 'attrs', 'json_extra',
         'any_attr', 'simple_type', 'json_text_attr', 'elem',
         'is_abstract', 'is_list', 'json_list_name', 'json_name',
-        'enum_values', 'list_item_type'
+        'enum_values', 'list_item_type', 'qname'
     ]
 
     def __init__(self, namespace, name, elem, is_abstract):
 
+        # these are referenced by many elements and used as dict keys
         self.namespace = namespace
-        self.name = name
+        self.name = _intern(name)
+        if namespace:
+            self.qname = _intern('{%s}%s' % (namespace, name))
+        else:
+            self.qname = self.name
         self.is_abstract = is_abstract
 
         # key: qname
         # value: ElementData
         # -> keep the elements in insertion order, so we can emit the
         #    xml elements in the correct order
-        self.elements = OrderedDict()
+        self.elements = ordered_dict()
         self.attrs = {}
 
         # extra attributes that are returned from JSON that the XML doesn't support
@@ -133,10 +191,6 @@ class TypeData(object):
         self.enum_values = []
         self.list_item_type = None
 
-    @property
-    def qname(self):
-        return '{%s}%s' % (self.namespace, self.name)
-
     def finish(self):
         # If it's a simple type, and there are attrs, then we need to look it
         # up in a map, as we have no idea what the type actually is
@@ -144,7 +198,19 @@ class TypeData(object):
             # assume that it's Value, as that's what we've seen so far...
             self.json_text_attr = 'Value'
 
+        # element names don't change after this, so shorten them now
+        for k, v in self.elements.items():
+            v.xml_short_name = shorten_qname(v.xml_name or k)
+
     def __repr__(self):
+        # keep this cheap, the elements refer to other types which would
+        # make a full repr of the type graph enormous
+        return '<TypeData %s n_elems=%d n_attrs=%d%s>' % (
+            self.name, len(self.elements), len(self.attrs),
+            '' if not self.simple_type else ' simple'
+        )
+
+    def debug_repr(self):
         #dump(self.elem)
         return '<TypeData %s elems=%r attrs=%r%s>' % (
             self.name, self.elements, self.attrs,
@@ -169,6 +235,13 @@ class SoapOperation(object):
         self.in_headers = in_headers
         self.out_headers = out_headers
 
+        self.out_short_name = shorten_qname(out_elem)
+        self.out_local_name = _split_qname(out_elem)[1]
+
+        # names of the types of in_elem/out_elem, set by resolve_operation_types
+        self.in_type_name = None
+        self.out_type_name = None
+
 
 def _create_choice_hacks():
 
@@ -177,7 +250,7 @@ def _create_choice_hacks():
 
     # TODO: I think the arrays might be incorrect..
 
-    return {
+    hacks = {
         m + "ArrayOfResponseMessagesType": "Items",
         m + "ArrayOfServiceConfigurationType": "",
         m + "FindConversationType:0": "Paging",
@@ -262,6 +335,19 @@ def _create_choice_hacks():
         t + "UserConfigurationNameType": "BaseFolderId",
     }
 
+    # key the lookup on (qname, choice index) so that process_type doesn't
+    # have to format a string for every lookup
+    choice_hacks = {}
+    for key, json_name in hacks.items():
+        qname, _, idx = key.rpartition(':')
+        if idx.isdigit():
+            key = (_intern(qname), int(idx))
+        else:
+            key = (_intern(key), None)
+        choice_hacks[key] = json_name
+
+    return choice_hacks
+
 choice_hacks = _create_choice_hacks()
 
 def apply_hacks(operations, types, elements):
@@ -414,20 +500,22 @@ def apply_hacks(operations, types, elements):
            'IsLessThan', 'IsLessThanOrEqualTo', 'IsNotEqualTo']
 
     all_searchexp = other + two + one
+    all_keys = tuple(_intern(t + en) for en in all_searchexp)
+    field_keys = tuple(_intern(t + en) for en in
+                       ['ExtendedFieldURI', 'FieldURI', 'IndexedFieldURI'])
 
-    for tt in all_searchexp:
-        re[t + tt].json_name = 'Item'
+    for k in all_keys:
+        re[k].json_name = 'Item'
 
     for tt in two:
         et = types[t + tt + 'Type'].elements
-        for en in all_searchexp:
-            et[t + en].json_name = 'Item'
+        for k in all_keys:
+            et[k].json_name = 'Item'
 
     for tt in one + ['ContainsExpression']:
         et = types[t + tt + 'Type'].elements
-        et[t + 'ExtendedFieldURI'].json_name = 'Item'
-        et[t + 'FieldURI'].json_name = 'Item'
-        et[t + 'IndexedFieldURI'].json_name = 'Item'
+        for k in field_keys:
+            et[k].json_name = 'Item'
 
     # end search expression madeness
     
@@ -462,8 +550,11 @@ def apply_hacks(operations, types, elements):
 
 
 def process_element(e, elements, types, cls_hierarchy):
-    typ = getattr(e, 'type', None)
-    if not typ:
+    try:
+        typ = e.type
+    except AttributeError:
+        return None, None
+    if typ is None:
         return None, None
 
     ename = e.name
@@ -482,11 +573,23 @@ def process_element(e, elements, types, cls_hierarchy):
     if e.max_occurs == None or e.max_occurs > 1:
         edata.is_list = True
 
+    ename = _intern(ename)
     elements[ename] = edata
     return ename, edata
 
+# key: id() of an xmlschema type object
+# value: (the type object, the TypeData created for it)
+# -> this catches anonymous types, which aren't found by name in types. The
+#    type object is kept so that a reused id can't match a different type,
+#    and process_schema empties this once it's done with a schema
+_typ_obj_cache = {}
+
 def process_type(typ, types, parent_name, cls_hierarchy):
 
+    cached = _typ_obj_cache.get(id(typ))
+    if cached and cached[0] is typ:
+        return cached[1]
+
     typ_qname = typ.name
 
     data = types.get(typ_qname)
@@ -496,19 +599,27 @@ def process_type(typ, types, parent_name, cls_hierarchy):
     # create named types
     elif typ_qname:
         # split namespace/name
-        typ_ns, typ_name = split_qname(typ_qname)
+        typ_ns, typ_name, _ = _split_qname(typ_qname)
         if typ_ns in namespaces:
             data = TypeData(typ_ns, typ_name, typ.elem, getattr(typ, 'abstract', False))
-            types[typ.name] = data
+            types[_intern(typ_qname)] = data
+            _typ_obj_cache[id(typ)] = (typ, data)
     # and unnamed types if the anonymous type isn't simple
     elif not typ.is_simple() and parent_name:
-        _, parent_name = split_qname(parent_name)
-        typ_name = parent_name + 'AnonType'
+        parent_name = _split_qname(parent_name)[1]
+        typ_name = _intern(parent_name + 'AnonType')
         data = TypeData(None, typ_name, typ.elem, getattr(typ, 'abstract', False))
         types[typ_name] = data
+        _typ_obj_cache[id(typ)] = (typ, data)
 
     # process attributes first
-    for attrname, attr in getattr(typ, 'attributes', {}).items():
+    # -> simple types don't have any
+    try:
+        attributes = typ.attributes
+    except AttributeError:
+        attributes = {}
+
+    for attrname, attr in attributes.items():
         # the 'any' attribute is represented as None
         if not attrname:
             if data:
@@ -521,15 +632,15 @@ def process_type(typ, types, parent_name, cls_hierarchy):
             # in a custom way?
             continue
 
-        _, attr_name = split_qname(attrname)
-        data.attrs[attr_name] = process_type(attr.type, types, None, cls_hierarchy)
+        attr_name = _split_qname(attrname)[1]
+        data.attrs[_intern(attr_name)] = process_type(attr.type, types, None, cls_hierarchy)
 
     if typ.is_simple():
         # default to string
         simple_type = 'string'
 
         if hasattr(typ, 'primitive_type'):
-            _, pname = split_qname(typ.primitive_type.name)
+            pname = _split_qname(typ.primitive_type.name)[1]
             if pname in ['boolean', 'decimal']:
                 simple_type = pname
 
@@ -543,11 +654,9 @@ def process_type(typ, types, parent_name, cls_hierarchy):
         if hasattr(typ, 'elem'):
             restriction = typ.elem
             data.enum_values = []
-            for child in restriction.getchildren():
-                    ns, tagname = split_qname(child.tag)
-                    if tagname == 'enumeration':
-                        value = child.attrib['value']
-                        data.enum_values.append(value)
+            for child in restriction:
+                if child.tag == ENUM_TAG:
+                    data.enum_values.append(child.attrib['value'])
 
 
     else:
@@ -559,6 +668,9 @@ def process_type(typ, types, parent_name, cls_hierarchy):
         content = typ.content_type
         content_is_choice = False
 
+        # looked up for every element in _process
+        subst_groups = typ.schema.maps.substitution_groups
+
         if isinstance(content, XsdGroup) and content.model == XSD_CHOICE_TAG:
             content_is_choice = True
 
@@ -568,8 +680,6 @@ def process_type(typ, types, parent_name, cls_hierarchy):
            content[0].name is None and isinstance(content[0], XsdGroup):
            content = content[0]
 
-        content_elements = [el for el in content]
-
         # bug in xmlschema -- it adds base elements to a content type group
         # if it exists -- so switch it up
         if isinstance(content, XsdGroup) and \
@@ -577,12 +687,19 @@ def process_type(typ, types, parent_name, cls_hierarchy):
             content.model == XSD_CHOICE_TAG:
 
             new_elements = []
+            remaining = []
 
             # subtract the base types from the group
             base = typ.extends_type
+            base_ids = {id(e) for e in base.content_type}
 
-            for e in base.content_type:
-                new_elements.append(content_elements.pop(content_elements.index(e)))
+            for e in content:
+                if id(e) in base_ids:
+                    new_elements.append(e)
+                else:
+                    remaining.append(e)
+
+            content_elements = remaining
 
             # if there are no elements left, then the choice is actually in the base
             # -> but if there are, then add a pseudo group
@@ -592,6 +709,9 @@ def process_type(typ, types, parent_name, cls_hierarchy):
                 new_elements.append(XsdGroup(model=XSD_CHOICE_TAG, initlist=content_elements))
                 content_elements = new_elements
                 content_is_choice = False
+        else:
+            # nothing to rearrange, so just iterate the content directly
+            content_elements = content
 
         if content.max_occurs is None or content.max_occurs > 1:
             data.is_list = True
@@ -613,7 +733,7 @@ def process_type(typ, types, parent_name, cls_hierarchy):
             # json name to the base element name
             # -> I don't remember why I thought that, but it doesn't seem to be true
 
-            subst = typ.schema.maps.substitution_groups.get(el.name)
+            subst = subst_groups.get(el.name)
             if subst:
 
                 # if the subst element has max_occurs, then the parent is
@@ -622,25 +742,30 @@ def process_type(typ, types, parent_name, cls_hierarchy):
                 if el.max_occurs is None or el.max_occurs > 1:
                     data.json_list_name = 'Items'
 
+                base_local = _split_qname(el.name)[1]
                 for sel in subst:
                     _, edata = process_element(sel, elements, types, cls_hierarchy)
                     # TODO: necessary?
                     #if p.model != XSD_CHOICE_TAG:
-                    edata.json_name = split_qname(el.name)[1]
+                    edata.json_name = base_local
 
             # turns out that the same thing applies to abstract types
             elif edata and edata.type.is_abstract and not edata.type.simple_type:
-                children = cls_hierarchy[edata.type.qname]
-                for i, child in enumerate(children):
+                children = cls_hierarchy[edata.type.qname][0]
+
+                # only the type differs between the children
+                template = edata.clone()
+                template.xml_name = ename
+                if not template.json_name:
+                    template.json_name = _split_qname(ename)[1]
+
+                for child in children:
                     ctype = process_type(child, types, None, cls_hierarchy)
-                    cdata = copy.deepcopy(edata)
+                    cdata = template.clone()
                     cdata.type = ctype
-                    cdata.xml_name = ename
-                    if not cdata.json_name:
-                        cdata.json_name = split_qname(ename)[1]
                     if child.name in elements:
                         raise ValueError("Internal error, need to figure this name thing out")
-                    elements[child.name] = cdata
+                    elements[_intern(child.name)] = cdata
 
 
         # So this is difficult -- any time we encounter a choice element,
@@ -650,12 +775,7 @@ def process_type(typ, types, parent_name, cls_hierarchy):
         # there isn't a way to predict the name in all cases, so instead
         # we have a lookup table that ensures we cover all of the bases. Oi.
         def _get_group_json_name(tname, idx):
-            if idx is not None:
-                name = '%s:%s' % (tname, idx)
-            else:
-                name = tname
-
-            return choice_hacks[name]
+            return choice_hacks[(tname, idx)]
 
         outer_json_name = None
         inner_json_name = None
@@ -688,8 +808,10 @@ def process_type(typ, types, parent_name, cls_hierarchy):
 
         # if there is a single element and that element is a list, then
         # we collapse the element to its parent
-        if len(data.attrs) == 0 and len(elements) == 1 and elements.values()[0].is_list:
-            data.is_list = True
+        if not data.attrs and len(elements) == 1:
+            only = next(iter(elements.values()))
+            if only.is_list:
+                data.is_list = True
 
     return data
 
@@ -704,14 +826,32 @@ def process_builtins(types, cls_hierarchy):
 
 def process_schema(fname, elements, types, cls_hierarchy):
     xsd = xmlschema.XMLSchema(fname)
+    try:
+        _process_schema(xsd, elements, types, cls_hierarchy)
+    finally:
+        _typ_obj_cache.clear()
+
+def _process_schema(xsd, elements, types, cls_hierarchy):
 
     # process the class hierarchy first
+    # -> also record the depth of each type, so that base types can be
+    #    processed before the types derived from them
+    by_depth = []
     for typ in xsd.types.values():
+        depth = 0
         tex = getattr(typ, 'extends_type', None)
         while tex is not None:
+            depth += 1
             if tex.name:
-                cls_hierarchy.setdefault(tex.name, set()).add(typ)
+                # (subtypes in order, ids of the subtypes)
+                entry = cls_hierarchy.setdefault(tex.name, ([], set()))
+                if id(typ) not in entry[1]:
+                    entry[1].add(id(typ))
+                    entry[0].append(typ)
             tex = getattr(tex, 'extends_type', None)
+        by_depth.append((depth, typ))
+
+    by_depth.sort(key=lambda d: d[0])
 
     # assumption is that the client/server are creating correct things,
     # so we're not going to try and correct them... and if they do create
@@ -720,7 +860,7 @@ def process_schema(fname, elements, types, cls_hierarchy):
     for el in xsd.elements.values():
         process_element(el, elements, types, cls_hierarchy)
 
-    for typ in xsd.types.values():
+    for _, typ in by_depth:
         process_type(typ, types, None, cls_hierarchy)
 
 
@@ -736,23 +876,51 @@ def process_wsdl(fname, operations):
         't': 'http://schemas.microsoft.com/exchange/services/2006/types',
     }
 
+    # prefix -> braced namespace
+    pfx = {k: '{' + v + '}' for k, v in ns.items()}
+
     def _expandns(n):
-        if ':' in n:
-            s = n.split(':')
-            n = '{%s}%s' % (ns[s[0]], s[1])
-        return n
+        p, c, l = n.partition(':')
+        return pfx[p] + l if c else n
 
     messages = {}
 
     tree = ET.parse(fname)
     root = tree.getroot()
 
+    # compile each query once, they all return a list of matching children
+    if hasattr(ET, 'XPath'):
+        def _compile(path):
+            return ET.XPath(path, namespaces=ns)
+    else:
+        def _compile(path):
+            return lambda elem: elem.findall(path, ns)
+
+    xp_message = _compile('wsdl:message')
+    xp_part = _compile('wsdl:part')
+    xp_port_type = _compile('wsdl:portType')
+    xp_binding = _compile('wsdl:binding')
+    xp_operation = _compile('wsdl:operation')
+    xp_input = _compile('wsdl:input')
+    xp_output = _compile('wsdl:output')
+    xp_body = _compile('soap:body')
+    xp_header = _compile('soap:header')
+
+    def _single_literal_body(op_elem, op_name):
+        body = xp_body(op_elem)
+
+        # make sure it matches what it should be
+        if len(body) != 1 or body[0].attrib['use'] != 'literal':
+            raise ValueError("Unexpected body: %s/%s" % (op_name, body))
+
+        return body[0]
+
     # gather the messages
-    for child in root.findall('wsdl:message', ns):
+    for child in xp_message(root):
         # map part name to element
         msg = {}
 
-        for part in child.findall('wsdl:part', ns):
+        for part in xp_part(child):
             msg[part.attrib['name']] = _expandns(part.attrib['element'])
 
         messages[child.attrib['name']] = msg
@@ -760,11 +928,11 @@ def process_wsdl(fname, operations):
     # iterate the port type to bind them
     # .. who came up with this crap
     port_ops = {}
-    port_type = root.find('wsdl:portType', ns)
-    for child in port_type.findall('wsdl:operation', ns):
+    port_type = xp_port_type(root)[0]
+    for child in xp_operation(port_type):
 
-        in_msg = messages[child.find('wsdl:input', ns).attrib['message'].split(':')[1]]
-        out_msg = messages[child.find('wsdl:output', ns).attrib['message'].split(':')[1]]
+        in_msg = messages[xp_input(child)[0].attrib['message'].split(':')[1]]
+        out_msg = messages[xp_output(child)[0].attrib['message'].split(':')[1]]
 
         port_ops[child.attrib['name']] = {
             'in': in_msg,
@@ -772,46 +940,43 @@ def process_wsdl(fname, operations):
         }
 
     # for each operation, extract the message types
-    binding = root.find('wsdl:binding', ns)
-    for child in binding.findall('wsdl:operation', ns):
+    binding = xp_binding(root)[0]
+    for child in xp_operation(binding):
         op_name = child.attrib['name']
 
         # get the input and check
-        op_input = child.find('wsdl:input', ns)
-        body = list(op_input.findall('soap:body', ns))
-
-        # make sure it matches what it should be
-        if len(body) != 1 or body[0].attrib['use'] != 'literal':
-            raise ValueError("Unexpected body: %s/%s" % (op_name, body))
-
-        body = body[0]
+        op_input = xp_input(child)[0]
+        body = _single_literal_body(op_input, op_name)
         in_elem = port_ops[op_name]['in'][body.attrib['parts']]
 
         # get the output
-        op_output = child.find('wsdl:output', ns)
-        body = list(op_output.findall('soap:body', ns))
-
-        # make sure it matches what it should be
-        if len(body) != 1 or body[0].attrib['use'] != 'literal':
-            raise ValueError("Unexpected body: %s" % body)
-
-        body = body[0]
+        op_output = xp_output(child)[0]
+        body = _single_literal_body(op_output, op_name)
         out_elem = port_ops[op_name]['out'][body.attrib['parts']]
 
         in_headers = []
         out_headers = []
 
         # get the header too, but there are multiple elements
-        for header in op_input.findall('soap:header', ns):
+        for header in xp_header(op_input):
             in_headers.append(port_ops[op_name]['in'][header.attrib['part']])
 
-        for header in op_output.findall('soap:header', ns):
+        for header in xp_header(op_output):
             out_headers.append(port_ops[op_name]['out'][header.attrib['part']])
 
         operations[op_name] = SoapOperation(op_name, in_elem, out_elem,
                                             in_headers, out_headers)
 
 
+def resolve_operation_types(operations, elements):
+
+    # the element types don't change after they're processed, so only look
+    # them up once
+    for op in operations.values():
+        op.in_type_name = elements[op.in_elem].type.name
+        op.out_type_name = elements[op.out_elem].type.name
+
+
 def create_header_types(operations, types, elements):
 
     # define JsonRequestHeaders and JsonResponseHeaders
@@ -826,6 +991,9 @@ def create_header_types(operations, types, elements):
         for hdr in op.out_headers:
             response_type.elements[hdr] = elements[hdr]
 
+    request_type.finish()
+    response_type.finish()
+
     types["JsonRequestHeaders"] = request_type
     types["JsonResponseHeaders"] = response_type
 
@@ -850,6 +1018,9 @@ func init() {
 var ewsTypes = map[string]*EwsType{
 '''
 
+# indexed by a bool
+_BOOLSTR = ("false", "true")
+
 golang_simple_type_map = {
     'boolean': 'T_BOOL',
     'decimal': 'T_NUM',
@@ -858,25 +1029,58 @@ golang_simple_type_map = {
     'list': 'T_LIST'
 }
 
-golang_schema_fmt = '''\t"%(typename)s": {
-\t\tName: "%(typename)s", JsonType: "%(jsontype)s",
-\t\telements: []element{%(elements)s},%(jsonextra)s
-\t\tAttributes: []element{%(attrs)s},
-\t\tIsList: %(islist)s, IsSimple: %(simple)s,%(simple_type)s
-\t\tAnyAttr: %(any)s, TextAttr: "%(textattr)s",%(json_list_name)s
-\t\tEnumValues: []string{%(enum_values)s},
-\t\tListItemTypeStr: "%(list_item_type)s",
+# used when a type has json_extra, json_list_name, or simple_type set
+# positional: typename, typename, jsontype, elements, jsonextra, attrs,
+#             islist, simple, simple_type, any, textattr, json_list_name,
+#             enum_values, list_item_type
+golang_schema_fmt_full = '''\t"%s": {
+\t\tName: "%s", JsonType: "%s",
+\t\telements: []element{%s},%s
+\t\tAttributes: []element{%s},
+\t\tIsList: %s, IsSimple: %s,%s
+\t\tAnyAttr: %s, TextAttr: "%s",%s
+\t\tEnumValues: []string{%s},
+\t\tListItemTypeStr: "%s",
 \t},
+
 '''
 
-golang_op_fmt = '''\t"%(opname)s": {
-\t\tAction: "%(action)s",
-\t\tBodyType: "%(action)sRequest:#Exchange",
-\t\tRequestType: "%(action)sJsonRequest:#Exchange", Request: ewsTypes["%(in_type)s"],
-\t\tResponse: EwsJsonElement{JsonName: "%(rname)s", SingleType: NewEwsJsonType("%(out_elem)s", ewsTypes["%(out_type)s"])},
+# the common case, where none of those are set
+# positional: typename, typename, jsontype, elements, attrs, islist, any,
+#             textattr, enum_values, list_item_type
+golang_schema_fmt_bare = '''\t"%s": {
+\t\tName: "%s", JsonType: "%s",
+\t\telements: []element{%s},
+\t\tAttributes: []element{%s},
+\t\tIsList: %s, IsSimple: false,
+\t\tAnyAttr: %s, TextAttr: "%s",
+\t\tEnumValues: []string{%s},
+\t\tListItemTypeStr: "%s",
 \t},
+
 '''
 
+# positional: opname, action, action, action, in_type, rname, out_elem, out_type
+golang_op_fmt = '''\t"%s": {
+\t\tAction: "%s",
+\t\tBodyType: "%sRequest:#Exchange",
+\t\tRequestType: "%sJsonRequest:#Exchange", Request: ewsTypes["%s"],
+\t\tResponse: EwsJsonElement{JsonName: "%s", SingleType: NewEwsJsonType("%s", ewsTypes["%s"])},
+\t},
+
+'''
+
+# each row includes its own leading newline and indentation
+# positional: xml name, type/json name fragment
+golang_attr_fmt = '\n\t\t\t{XN: "%s"%s},'
+
+# positional: xml name, jname, type, is_list, json_default, jhint
+golang_elem_fmt = '\n\t\t\t{XN: "%s"%s, T: "%s"%s%s%s},'
+
+# elements that have none of the optional fields, which is most of them
+# positional: xml name, type
+golang_elem_simple_fmt = '\n\t\t\t{XN: "%s", T: "%s"},'
+
 golang_footer = '''
 
 // separate so we don't have to do an additional map lookup on each request
@@ -888,125 +1092,161 @@ var EwsSoapResponseHeader = EwsJsonElement{
 
 '''
 
-def generate_golang(elements, types, operations, fp):
+def _render_attr(n, v):
+    t = ''
+    if v:
+        t = ', T: "%s"' % v.name
+        if v.json_name:
+            t += ', JN: "%s"' % v.json_name
 
-    print(golang_header, file=fp)
+    return golang_attr_fmt % (n, t)
 
-    for typename in sorted(types):
-        typ = types[typename]
 
-        jsontype = ''
+def _render_element(typename, k, v):
+    jname = ''
+    jhint = ''
+    is_list = ''
+    json_default = ''
 
-        # only define json type for non anonymous types
-        if not typ.name.endswith('AnonType'):
-            # allow override of json types
-            if typ.json_name:
-                jsontype = typ.json_name
-            else:
-                jsontype = typ.name
-                if jsontype.endswith('Type'):
-                    jsontype = jsontype[:-4]
-            jsontype += ":#Exchange"
-
-        attrs = ""
-        if typ.attrs:
-            aa = []
-            for n, v in sorted(typ.attrs.items()):
-                t = ''
-                if v:
-                    t = ', T: "%s"' % v.name
-                    if v.json_name:
-                        t += ', JN: "%s"' % v.json_name
-
-                aa.append('{XN: "%s"%s},' % (n, t))
-
-            attrs = '\n\t\t\t' + '\n\t\t\t'.join(aa) + '\n\t\t'
-
-        elems = ""
-        if typ.elements:
-            ee = []
-            for k,v in typ.elements.items():
-                jname = ''
-                jhint = ''
-                if v.xml_name:
-                    ename = shorten_qname(v.xml_name)
-                else:
-                    ename = shorten_qname(k)
-                is_list = ''
-                json_default = ''
+    if not v.type:
+        raise ValueError("Should not happen anymore: %s // %s" % (typename, k))
 
-                if not v.type:
-                    raise ValueError("Should not happen anymore: %s // %s" % (typename, k))
+    ename = v.xml_short_name
+    if ename is None:
+        # TypeData.finish wasn't called for this element's type
+        ename = shorten_qname(v.xml_name or k)
 
-                if v.is_list:
-                    is_list = ', List: true'
+    if not (v.json_name or v.json_hint or v.json_default or v.is_list):
+        return golang_elem_simple_fmt % (ename, v.type.name)
 
-                if v.json_name:
-                    jname = ', JN: "%s"' % v.json_name
-                
-                if v.json_hint:
-                    jhint = ', JT: "%s"' % v.json_hint
+    if v.is_list:
+        is_list = ', List: true'
 
-                if v.json_default:
-                    json_default = ', JsonDefault: %s' % v.json_default
+    if v.json_name:
+        jname = ', JN: "%s"' % v.json_name
 
-                ee.append('{XN: "%s"%s, T: "%s"%s%s%s},' % (ename, jname, v.type.name, is_list, json_default, jhint))
+    if v.json_hint:
+        jhint = ', JT: "%s"' % v.json_hint
 
-            elems = '\n\t\t\t' + '\n\t\t\t'.join(ee) + '\n\t\t'
+    if v.json_default:
+        json_default = ', JsonDefault: %s' % v.json_default
 
-        json_extra = ''
-        if typ.json_extra:
-            json_extra = '\n\t\t\t\tJsonExtra: []string{"%s"},' % '", "'.join(typ.json_extra)
+    return golang_elem_fmt % (ename, jname, v.type.name, is_list, json_default, jhint)
 
-        json_list_name = ''
-        if typ.json_list_name:
-            json_list_name = '\n\t\tJsonListName: "%s",' % typ.json_list_name
 
-        simple_type = ''
-        if typ.simple_type:
-            simple_type = ' SimpleType: %s,' % golang_simple_type_map[typ.simple_type]
+def _render_type(typename, typ):
+    jsontype = ''
 
-        enum_values = ", ".join('"{0}"'.format(value) for value in typ.enum_values)
+    # only define json type for non anonymous types
+    if not typ.name.endswith('AnonType'):
+        # allow override of json types
+        if typ.json_name:
+            jsontype = typ.json_name
+        else:
+            jsontype = typ.name
+            if jsontype.endswith('Type'):
+                jsontype = jsontype[:-4]
+        jsontype += ":#Exchange"
+
+    attrs = ""
+    if typ.attrs:
+        attrs = ''.join(_render_attr(n, v) for n, v in sorted(typ.attrs.items())) + '\n\t\t'
+
+    elems = ""
+    if typ.elements:
+        elems = ''.join(_render_element(typename, k, v) for k, v in typ.elements.items()) + '\n\t\t'
+
+    enum_values = ''
+    if typ.enum_values:
+        enum_values = ", ".join('"%s"' % value for value in typ.enum_values)
+
+    if not (typ.json_extra or typ.json_list_name or typ.simple_type):
+        return golang_schema_fmt_bare % (
+            typ.name, typ.name, jsontype,
+            elems, attrs,
+            _BOOLSTR[bool(typ.is_list)],
+            _BOOLSTR[bool(typ.any_attr)],
+            "" if not typ.json_text_attr else typ.json_text_attr,
+            enum_values,
+            "" if not typ.list_item_type else typ.list_item_type
+        )
+
+    json_extra = ''
+    if typ.json_extra:
+        json_extra = '\n\t\t\t\tJsonExtra: []string{"%s"},' % '", "'.join(typ.json_extra)
+
+    json_list_name = ''
+    if typ.json_list_name:
+        json_list_name = '\n\t\tJsonListName: "%s",' % typ.json_list_name
+
+    simple_type = ''
+    if typ.simple_type:
+        simple_type = ' SimpleType: %s,' % golang_simple_type_map[typ.simple_type]
+
+    return golang_schema_fmt_full % (
+        typ.name, typ.name, jsontype,
+        elems, json_extra,
+        attrs,
+        _BOOLSTR[bool(typ.is_list)],
+        _BOOLSTR[bool(typ.simple_type)],
+        simple_type,
+        _BOOLSTR[bool(typ.any_attr)],
+        "" if not typ.json_text_attr else typ.json_text_attr,
+        json_list_name,
+        enum_values,
+        "" if not typ.list_item_type else typ.list_item_type
+    )
+
+
+def _render_op(opname, op, elements):
+    action = op.action
+
+    # fall back to looking the types up if resolve_operation_types wasn't
+    # called, which raises KeyError for unknown elements
+    in_type = op.in_type_name
+    if in_type is None:
+        in_type = elements[op.in_elem].type.name
+
+    out_type = op.out_type_name
+    if out_type is None:
+        out_type = elements[op.out_elem].type.name
 
+    return golang_op_fmt % (
+        opname, action, action, action, in_type,
+        op.out_local_name, op.out_short_name, out_type
+    )
 
-        print(golang_schema_fmt % dict(
-            typename=typ.name, jsontype=jsontype,
-            elements=elems, attrs=attrs,
-            any="true" if typ.any_attr else "false",
-            simple="true" if typ.simple_type else "false",
-            simple_type=simple_type,
-            islist="true" if typ.is_list else "false",
-            textattr="" if not typ.json_text_attr else typ.json_text_attr,
-            jsonextra=json_extra, json_list_name=json_list_name,
-            enum_values=enum_values,
-            list_item_type="" if not typ.list_item_type else typ.list_item_type
-        ), file=fp)
 
-    print("}\n", file=fp)
+def render_golang(elements, types, operations):
+    '''Returns the contents of the generated golang file'''
+
+    parts = [golang_header, '\n']
+
+    for typename, typ in sorted(types.items()):
+        parts.append(_render_type(typename, typ))
+
+    parts.append("}\n\n")
 
     # generate xml message lookups
     # -> indexed by input action name
-    print('var EwsOperations = map[string]*OpDescriptor{', file=fp)
-
-    for opname in sorted(operations):
-        op = operations[opname]
-        in_type = elements[op.in_elem].type.name
-        out_type = elements[op.out_elem].type.name
+    parts.append('var EwsOperations = map[string]*OpDescriptor{\n')
 
-        print(golang_op_fmt % dict(
-            opname=opname,
-            action=op.action,
-            in_type=in_type, out_type=out_type,
-            out_elem=shorten_qname(op.out_elem),
-            rname=split_qname(op.out_elem)[1],
-        ), file=fp)
+    for opname, op in sorted(operations.items()):
+        parts.append(_render_op(opname, op, elements))
 
-    print("}\n", file=fp)
+    parts.append("}\n\n")
 
     # generate a lookup to go the other way JSON -> XML
 
     # and the footer
-    print(golang_footer, file=fp)
+    parts.append(golang_footer)
+    parts.append('\n')
+
+    return ''.join(parts)
+
+
+def generate_golang(elements, types, operations, fp):
+    fp.write(render_golang(elements, types, operations))
 
 
 if __name__ == '__main__':
@@ -1033,6 +1273,7 @@ if __name__ == '__main__':
         v.finish()
 
     process_wsdl(join(thisdir, 'services.wsdl'), operations)
+    resolve_operation_types(operations, elements)
 
     # do this separately in case we want to reuse this in
     # the future...
@@ -1041,5 +1282,12 @@ if __name__ == '__main__':
     # manual adjustments to schemas when we just can't make sense of it all
     apply_hacks(operations, types, elements)
 
-    with open(outfile, 'w') as fp:
-        generate_golang(elements, types, operations, fp)
+    # the whole file is rendered in memory, so skip the file object and
+    # write it out directly
+    data = render_golang(elements, types, operations).encode('utf-8')
+    fd = os.open(outfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
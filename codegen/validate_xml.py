@@ -2,8 +2,11 @@
 
 from __future__ import print_function
 
+import hashlib
+import json
+import multiprocessing
 import os
-from os.path import abspath, dirname, join
+from os.path import abspath, dirname, expanduser, join
 import sys
 import traceback
 from lxml import etree
@@ -11,38 +14,179 @@ from lxml import etree
 # Validates the body of EWS XML files against the appropriate schemas.
 
 root = abspath(dirname(__file__))
-schema_doc = etree.parse(join(root, 'messages.xsd'))
-my_schema = etree.XMLSchema(schema_doc)
+
+# compiled schemas can't be pickled, so they can't be cached on disk or sent
+# to the worker processes. Instead the schema is compiled once in the main
+# process before the pool starts, and forked workers inherit it; workers that
+# are spawned instead build their own once via _init_schema
+my_schema = None
+
+def _init_schema():
+    global my_schema
+    if my_schema is not None:
+        return
+    schema_doc = etree.parse(join(root, 'messages.xsd'))
+    my_schema = etree.XMLSchema(schema_doc)
 
 ns = {'Soap': 'http://schemas.xmlsoap.org/soap/envelope/',
       'm': 'http://schemas.microsoft.com/exchange/services/2006/messages',
       't': 'http://schemas.microsoft.com/exchange/services/2006/types'}
 
+body_tag = '{%s}Body' % ns['Soap']
+
+# Files that passed validation are remembered here, and skipped on later runs
+# until they or the schemas change. Delete it to force everything to be
+# validated again
+cache_file = join(expanduser('~'), '.cache', 'ews-proxy', 'validated.json')
+
+xsd_ns = 'http://www.w3.org/2001/XMLSchema'
+xsd_ref_tags = set('{%s}%s' % (xsd_ns, t) for t in ['import', 'include', 'redefine'])
+xsd_annotation_tag = '{%s}annotation' % xsd_ns
+
+def schema_files(fname):
+    '''Returns fname and every local schema it imports/includes, recursively'''
+    files = []
+    pending = [abspath(fname)]
+    while pending:
+        f = pending.pop()
+        if f in files:
+            continue
+        files.append(f)
+
+        # references have to come before any of the declarations, so stop
+        # reading at the first top level element that isn't one
+        depth = 0
+        for event, elem in etree.iterparse(f, events=('start', 'end')):
+            if event == 'end':
+                depth -= 1
+                continue
+            depth += 1
+            if depth != 2:
+                continue
+            if elem.tag in xsd_ref_tags:
+                location = elem.get('schemaLocation')
+                if location and '://' not in location:
+                    pending.append(abspath(join(dirname(f), location)))
+            elif elem.tag != xsd_annotation_tag:
+                break
+
+    return files
+
+def _mtime(st):
+    # str() of a float only keeps 12 digits on python 2, which loses the
+    # sub-second part of the mtime, so use the exact value
+    try:
+        return st.st_mtime_ns
+    except AttributeError:
+        return repr(st.st_mtime)
+
+def _schema_stamp():
+    # messages.xsd and everything it pulls in affects the result
+    return '|'.join('%s:%s' % (f, _mtime(os.stat(f)))
+                    for f in schema_files(join(root, 'messages.xsd')))
+
+def cache_key(path, schema_stamp):
+    '''Computed from os.stat only, the file is not read'''
+    st = os.stat(path)
+    key = '%s|%s|%s|%s' % (abspath(path), _mtime(st), st.st_size, schema_stamp)
+    # on python 2 this is usually already a byte string, and encoding it
+    # would first decode it as ascii, which fails for non-ascii file names
+    if not isinstance(key, bytes):
+        try:
+            key = os.fsencode(key)
+        except AttributeError:
+            # python 2, unicode path given
+            key = key.encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+def load_cache():
+    try:
+        with open(cache_file) as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    try:
+        cache_dir = dirname(cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file, 'w') as fp:
+            json.dump(cache, fp)
+    except (IOError, OSError) as e:
+        print("Warning: could not write " + cache_file + ": " + str(e))
+
+def _check_element(file_name, elem):
+    '''Returns None if elem is valid, otherwise a message describing why not'''
+    try:
+        my_schema.assertValid(elem)
+    except etree.DocumentInvalid as e:
+        return file_name + " : FAILED at " + str(e)
+    except Exception as e:
+        return file_name + " : " + str(e)
+    return None
 
 def validate_file(file_name):
+    '''
+        Returns (ok, message), message describes the failure if not ok.
+        Nothing is printed here, so that all of the output can be written
+        by the main process at once
+    '''
 
     try:
-        tree = etree.parse(file_name)
-
-        body = tree.find('Soap:Body', ns)
-
-        # Validate the elements contained in the Body of the XML file
-        # This is necessary to strip the SOAP elements
-        for child in body:
-            try:
-                my_schema.assertValid(child)
-            except etree.DocumentInvalid as e:
-                print (file_name + " : FAILED at " + str(e))
-                return False
-            except Exception as e:
-                print (e)
-                return False
-
-        return True
+        body = None
+
+        # Stream the file instead of building the whole tree up front, the
+        # Body is validated and freed as soon as it has been parsed. The rest
+        # of the file is still parsed to make sure it is well formed
+        for _, elem in etree.iterparse(file_name, events=('end',), tag=body_tag):
+            if body is not None:
+                continue
+            body = elem
+
+            # Validate the elements contained in the Body of the XML file
+            # This is necessary to strip the SOAP elements
+            if len(body) == 1:
+                # the common case, EWS messages have a single request/response
+                failure = _check_element(file_name, body[0])
+            else:
+                failure = None
+                for child in body:
+                    failure = _check_element(file_name, child)
+                    if failure is not None:
+                        break
+
+            if failure is not None:
+                return False, failure
+
+            body.clear()
+
+        if body is None:
+            raise ValueError("no Soap:Body element found")
+
+        return True, None
     except Exception as e:
-        print(file_name + " could not be parsed, see error: " + e.message)
-        traceback.print_exc(e)
-        return False
+        return False, (file_name + " could not be parsed, see error: " + str(e) +
+                       "\n" + traceback.format_exc().rstrip())
+
+def find_xml_files(folder):
+    '''Returns a list of (name, path) for each xml file in folder'''
+    try:
+        scandir = os.scandir
+    except AttributeError:
+        # python 2 doesn't have scandir
+        return [(name, join(folder, name)) for name in os.listdir(folder)
+                if name.endswith('.xml')]
+
+    return [(entry.name, entry.path) for entry in scandir(folder)
+            if entry.name.endswith('.xml')]
+
+def _validate_one(paths):
+    xml_file, path = paths
+    ok, message = validate_file(path)
+    if ok:
+        message = xml_file + " : VALIDATED"
+    return path, ok, message
 
 if __name__ == '__main__':
     
@@ -51,18 +195,65 @@ if __name__ == '__main__':
         exit(1)
     
     folder = sys.argv[1]
-    xml_files = []
-    xml_files += [each for each in os.listdir(folder) if each.endswith('.xml')]
+    xml_files = find_xml_files(folder)
 
     success_count = 0
     fail_count = 0
-    total_count = xml_files.__len__()
-    for xml_file in xml_files:
-        if validate_file(folder + "/" + xml_file):
+    total_count = len(xml_files)
+
+    lines = []
+
+    # skip anything that has already been validated; only the main process
+    # touches the cache, so the workers don't have to coordinate
+    cache = load_cache()
+
+    # only the keys that were hit or added by this run are written back, so
+    # entries for changed files/schemas don't pile up
+    new_cache = {}
+    schema_stamp = _schema_stamp()
+    keys = {}
+    to_validate = []
+    for xml_file, path in xml_files:
+        try:
+            key = keys[path] = cache_key(path, schema_stamp)
+        except OSError:
+            # can't be cached, let validation report what's wrong with it
+            to_validate.append((xml_file, path))
+            continue
+
+        if cache.get(key):
+            new_cache[key] = True
             success_count += 1
-            print(xml_file + " : VALIDATED")
+            lines.append(xml_file + " : VALIDATED (cached)")
         else:
-            fail_count += 1
+            to_validate.append((xml_file, path))
+
+    if to_validate:
+        _init_schema()
+
+        pool = multiprocessing.Pool(initializer=_init_schema)
+        try:
+            for path, ok, message in pool.imap_unordered(_validate_one, to_validate, chunksize=64):
+                if ok:
+                    success_count += 1
+                    if path in keys:
+                        new_cache[keys[path]] = True
+                else:
+                    fail_count += 1
+                lines.append(message)
+        except:
+            # don't wait for the rest of the queue on an error or ctrl-c
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+    if new_cache != cache:
+        save_cache(new_cache)
+
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
 
     print(str(success_count) + " files passed out of " + str(total_count) + " files in " + folder)
     